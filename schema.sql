@@ -1,3 +1,5 @@
+PRAGMA auto_vacuum = INCREMENTAL;
+PRAGMA journal_mode = WAL;
 DROP TABLE IF EXISTS users;
 CREATE TABLE users (
   id integer PRIMARY KEY autoincrement,
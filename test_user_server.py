@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import os
+import logging
+import shutil
 import user_server
 import unittest
 import tempfile
@@ -8,6 +10,20 @@ import sqlite3
 from flask import json
 from contextlib import closing
 
+PROFILE_CONFIG = ['PROFILE', 'PROFILE_SAMPLE_RATE', 'PROFILE_KEEP',
+    'PROFILE_RECENT', 'PROFILE_TOKEN', 'PROFILE_DIR']
+
+
+class LogRecorder(logging.Handler):
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(record)
+
+
 class UserServerTestCase(unittest.TestCase):
 
   def setUp(self):
@@ -20,6 +36,24 @@ class UserServerTestCase(unittest.TestCase):
   def tearDown(self):
       os.close(self.db_file)
       os.unlink(user_server.app.config['DATABASE'])
+      for key in PROFILE_CONFIG:
+        user_server.app.config[key] = getattr(user_server, key)
+      user_server.configure_profiling()
+
+
+  def configure_profiling(self, **config):
+    user_server.app.config.update(config)
+    user_server.configure_profiling()
+
+
+  def capture_log(self):
+    recorder = LogRecorder()
+    handlers = user_server.app.logger.handlers
+    user_server.app.logger.handlers = [recorder]
+    def restore():
+      user_server.app.logger.handlers = handlers
+    self.addCleanup(restore)
+    return recorder.records
 
 
   def test_root(self):
@@ -397,6 +431,167 @@ class UserServerTestCase(unittest.TestCase):
     uri = name and '/users/Hans%20Huber' or '/users/1'
     response = self.app.delete(uri, content_type='application/json')
     self.assertEqual(response._status_code, 404)
+
+
+  def test_vacuum_db(self):
+    user_server.init_db('test_data.sql')
+    with closing(sqlite3.connect(
+        user_server.app.config['DATABASE'])) as db:
+      db.execute('INSERT INTO users SELECT NULL, name || id || "x", email,'
+          ' zeroblob(200000) FROM users')
+      db.commit()
+      db.execute('DELETE FROM users WHERE id > 3')
+      db.commit()
+    report = user_server.vacuum_db()
+    self.assertEqual(report['command'], 'vacuum')
+    self.assertTrue(report['bytes'] > 0)
+    self.assertNotIn('result', report)
+    with closing(sqlite3.connect(
+        user_server.app.config['DATABASE'])) as db:
+      row = db.execute('PRAGMA freelist_count').fetchone()
+      self.assertEqual(row[0], 0)
+
+
+  def test_vacuum_db_disabled(self):
+    open(user_server.app.config['DATABASE'], 'w').close()
+    with closing(sqlite3.connect(
+        user_server.app.config['DATABASE'])) as db:
+      db.execute('CREATE TABLE old (id integer)')
+    user_server.init_db('test_data.sql')
+    report = user_server.vacuum_db()
+    self.assertEqual(report['bytes'], 0)
+    self.assertIn('auto_vacuum is disabled', report['result'])
+
+
+  def test_analyze_db(self):
+    user_server.init_db('test_data.sql')
+    report = user_server.analyze_db()
+    self.assertEqual(report['command'], 'analyze')
+    with closing(sqlite3.connect(
+        user_server.app.config['DATABASE'])) as db:
+      row = db.execute(
+          'SELECT idx FROM sqlite_stat1 WHERE tbl="users"').fetchone()
+      self.assertEqual(row[0], 'name_index')
+    self.assertTrue(report['bytes'] > 0)
+
+
+  def test_check_db(self):
+    user_server.init_db('test_data.sql')
+    report = user_server.check_db()
+    self.assertEqual(report['result'], 'ok')
+    self.assertTrue(report['bytes'] > 0)
+    self.assertIn('check: ', user_server.maintenance('check'))
+
+
+  def test_backup_db(self):
+    user_server.init_db('test_data.sql')
+    target_file, target = tempfile.mkstemp()
+    try:
+      os.write(target_file, 'previous backup')
+      report = user_server.backup_db(target)
+      self.assertEqual(report['bytes'], os.path.getsize(target))
+      self.assertTrue(report['bytes'] > 1024)
+      with closing(sqlite3.connect(target)) as db:
+        row = db.execute('SELECT count(*) FROM users').fetchone()
+        self.assertEqual(row[0], 3)
+        row = db.execute('PRAGMA integrity_check').fetchone()
+        self.assertEqual(row[0], 'ok')
+    finally:
+      os.close(target_file)
+      os.unlink(target)
+
+
+  def test_backup_db_onto_itself(self):
+    user_server.init_db('test_data.sql')
+    self.assertRaises(ValueError, user_server.backup_db,
+        user_server.app.config['DATABASE'])
+    with closing(sqlite3.connect(
+        user_server.app.config['DATABASE'])) as db:
+      row = db.execute('SELECT count(*) FROM users').fetchone()
+      self.assertEqual(row[0], 3)
+
+
+  def test_profiles_disabled(self):
+    response = self.app.get('/profiles')
+    self.assertEqual(response._status_code, 404)
+
+
+  def test_profiles(self):
+    user_server.init_db('test_data.sql')
+    self.configure_profiling(PROFILE=True, PROFILE_SAMPLE_RATE=0,
+        PROFILE_KEEP=2, PROFILE_RECENT=3, PROFILE_TOKEN='secret',
+        PROFILE_DIR=tempfile.mkdtemp())
+    self.addCleanup(shutil.rmtree, user_server.app.config['PROFILE_DIR'])
+    self.app.get('/users/1', headers={'X-Profile': 'wrong'})
+    self.app.get('/users/1', headers={'X-Profile': u's\xe9cret'})
+    response = self.app.get('/profiles', headers={'X-Profile': 'wrong'})
+    self.assertEqual(response._status_code, 404)
+    response = self.app.get('/profiles', headers={'X-Profile': 'secret'})
+    self.assertEqual(json.loads(response.data)['profiles'], [])
+    for uri in ['/users', '/users/1', '/users/Hans%20Huber', '/users']:
+      response = self.app.get(uri, headers={'X-Profile': 'secret'})
+      self.assertEqual(response._status_code, 200)
+    self.assertEqual(len(user_server.profiles), 3)
+    self.assertEqual(len(os.listdir(
+        user_server.app.config['PROFILE_DIR'])), 3)
+    response = self.app.get('/profiles', headers={'X-Profile': 'secret'})
+    profiles = json.loads(response.data)['profiles']
+    self.assertEqual(len(profiles), 2)
+    self.assertTrue(profiles[0]['seconds'] >= profiles[1]['seconds'])
+    for profile in profiles:
+      self.assertIn(profile['endpoint'],
+          ['get_user', 'get_user_by_name', 'get_users'])
+      self.assertTrue(len(profile['sql']) > 0)
+      self.assertIn('SELECT', profile['sql'][0]['sql'])
+      self.assertIn('function calls', profile['profile'])
+    response = self.app.delete('/profiles', headers={'X-Profile': 'secret'})
+    self.assertEqual(json.loads(response.data)['profiles deleted'], 3)
+    self.assertEqual(os.listdir(user_server.app.config['PROFILE_DIR']), [])
+    self.app.patch('/users/1', data=json.dumps(
+          {
+            "email": "hanshu@example.com"
+          }
+        ),
+        content_type='application/json',
+        headers={'X-Profile': 'secret'}
+      )
+    response = self.app.get('/profiles', headers={'X-Profile': 'secret'})
+    statements = [s['sql'] for s in
+        json.loads(response.data)['profiles'][0]['sql']]
+    self.assertIn('COMMIT', statements)
+    self.assertIn('UPDATE users SET', statements[1])
+    self.assertNotIn('hanshu@example.com', response.data)
+
+
+  def test_profiles_configuration(self):
+    records = self.capture_log()
+    self.configure_profiling(PROFILE=True, PROFILE_SAMPLE_RATE=1)
+    self.assertEqual(user_server.profiling, False)
+    self.assertIn('profiling stays disabled', records[0].getMessage())
+    self.app.get('/users')
+    self.assertEqual(len(user_server.profiles), 0)
+    self.assertRaises(ValueError, self.configure_profiling,
+        PROFILE_TOKEN='s\xc3\xa9cret')
+    self.assertRaises(ValueError, self.configure_profiling,
+        PROFILE_TOKEN=u's\xe9cret')
+
+
+  def test_profile_dir_missing(self):
+    records = self.capture_log()
+    self.configure_profiling(PROFILE=True, PROFILE_SAMPLE_RATE=1,
+        PROFILE_DIR='/nonexistent')
+    response = self.app.get('/users')
+    self.assertEqual(response._status_code, 200)
+    self.assertEqual(len(user_server.profiles), 1)
+    self.assertEqual(len(records), 1)
+    self.assertIn('Could not write profile', records[0].getMessage())
+
+
+  def test_redact_sql(self):
+    self.assertEqual(user_server.redact_sql(
+        'UPDATE users SET name="Hans ""H"" Huber", email=\'a@b.c\' '
+        'WHERE id=12'),
+        'UPDATE users SET name=?, email=? WHERE id=?')
     
     
 if __name__ == '__main__':
@@ -17,12 +17,35 @@ from flask import Flask, abort, json, jsonify, request, url_for, \
     make_response, g, current_app
 from hashlib import md5
 from contextlib import closing
+from StringIO import StringIO
+from collections import deque
+import cProfile
+import heapq
+import hmac
+import itertools
+import os
+import pstats
+import random
 import re
+import sys
+import tempfile
+import threading
+import time
 import sqlite3
 
 ########## Configuration ###########
 DATABASE = 'users.db'
 DEBUG = True
+MAINTENANCE_STEP_PAGES = 100
+MAINTENANCE_STEP_PAUSE = 0.005
+MAINTENANCE_ANALYSIS_LIMIT = 1000
+PROFILE = False
+PROFILE_SAMPLE_RATE = 0.01
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN = None
+PROFILE_KEEP = 20
+PROFILE_RECENT = 200
+PROFILE_DIR = None
 ####################################
 
 
@@ -40,7 +63,58 @@ def user_repr(user):
   return user_r
 
 
-def connect_db():
+def timed(statement, method, *args):
+  """Calls method and adds the time it took to statement['seconds']."""
+  start = time.time()
+  try:
+    return method(*args)
+  finally:
+    statement['seconds'] += time.time() - start
+
+
+class ProfilingCursor(sqlite3.Cursor):
+  """A cursor that adds the time spent fetching rows to its statement."""
+
+  statement = None
+
+  def fetchone(self):
+    return timed(self.statement, sqlite3.Cursor.fetchone, self)
+
+  def fetchmany(self, *args):
+    return timed(self.statement, sqlite3.Cursor.fetchmany, self, *args)
+
+  def fetchall(self):
+    return timed(self.statement, sqlite3.Cursor.fetchall, self)
+
+
+class ProfilingConnection(sqlite3.Connection):
+  """
+  A connection that records every statement and commit with its duration,
+  including the time spent fetching the rows.
+  """
+
+  def __init__(self, *args, **kwargs):
+    sqlite3.Connection.__init__(self, *args, **kwargs)
+    self.statements = []
+
+  def record(self, sql):
+    statement = dict(sql=sql, seconds=0.0)
+    self.statements.append(statement)
+    return statement
+
+  def execute(self, sql, *args):
+    cursor = self.cursor(ProfilingCursor)
+    cursor.statement = self.record(sql)
+    return timed(cursor.statement, cursor.execute, sql, *args)
+
+  def commit(self):
+    return timed(self.record('COMMIT'), sqlite3.Connection.commit, self)
+
+
+def connect_db(profile=False):
+  if profile:
+    return sqlite3.connect(app.config['DATABASE'],
+        factory=ProfilingConnection)
   return sqlite3.connect(app.config['DATABASE'])
 
 
@@ -82,14 +156,160 @@ def get_uid_by_name(name, like=False):
   return row[0]
 
   
+profiles = deque()
+profiles_counter = itertools.count()
+profiles_lock = threading.Lock()
+profiling = False
+profile_token = None
+
+
+def clear_profiles():
+  """Removes all recorded profiles, and their dumps in PROFILE_DIR."""
+  with profiles_lock:
+    entries = list(profiles)
+    profiles.clear()
+  for entry in entries:
+    remove_profile_dump(entry)
+  return len(entries)
+
+
+def configure_profiling():
+  """
+  Applies the profiling configuration, call it again after changing
+  app.config. PROFILE_TOKEN has to be ASCII. Profiling stays disabled if
+  there is no way to look at the profiles, that is if neither
+  PROFILE_TOKEN nor PROFILE_DIR is set.
+  """
+  global profiles, profiling, profile_token
+  token = app.config['PROFILE_TOKEN']
+  if token != None:
+    try:
+      token = token.encode('ascii')
+    except UnicodeError, e:
+      raise ValueError('PROFILE_TOKEN must only contain ASCII characters')
+  enabled = app.config['PROFILE']
+  if enabled and token == None and app.config['PROFILE_DIR'] == None:
+    app.logger.warning('PROFILE is set, but neither PROFILE_TOKEN nor '
+        'PROFILE_DIR, profiling stays disabled')
+    enabled = False
+  clear_profiles()
+  profiles = deque(maxlen=app.config['PROFILE_RECENT'])
+  profiling = enabled
+  profile_token = token
+
+
+def redact_sql(sql):
+  """Replaces the string and number literals in sql with '?'."""
+  return re.sub(r'"(?:[^"]|"")*"|\'(?:[^\']|\'\')*\'|\b\d+(?:\.\d+)?\b',
+      '?', sql)
+
+
+def valid_profile_token():
+  """
+  Checks the PROFILE_HEADER of the current request against
+  PROFILE_TOKEN. Without a PROFILE_TOKEN, no request is valid.
+  """
+  token = request.headers.get(app.config['PROFILE_HEADER'])
+  if profile_token == None or token == None:
+    return False
+  try:
+    token = token.encode('ascii')
+  except UnicodeError, e:
+    return False
+  return hmac.compare_digest(token, profile_token)
+
+
+def profile_request():
+  """
+  Decides whether the current request is profiled. Profiling has to be
+  enabled with PROFILE, then PROFILE_SAMPLE_RATE of the requests are
+  profiled, as well as every request with a valid profile token.
+  """
+  if not profiling or request.endpoint in ['get_profiles', 'delete_profiles']:
+    return False
+  return random.random() < app.config['PROFILE_SAMPLE_RATE'] or \
+      valid_profile_token()
+
+
+def remove_profile_dump(entry):
+  if entry['dump'] != None:
+    try:
+      os.unlink(entry['dump'])
+    except OSError, e:
+      pass
+
+
+def record_profile(profiler, statements, seconds):
+  """
+  Adds the current request to the PROFILE_RECENT most recent profiles,
+  dropping the oldest one. If PROFILE_DIR is set, the profiler stats are
+  also dumped there, and removed again when the profile is dropped.
+  Formatting the profiles is left to get_profiles.
+  """
+  counter = next(profiles_counter)
+  dump = None
+  if app.config['PROFILE_DIR'] != None:
+    dump = os.path.join(app.config['PROFILE_DIR'],
+        '%i-%s.prof' % (counter, request.endpoint))
+    try:
+      profiler.dump_stats(dump)
+    except (IOError, OSError), e:
+      app.logger.exception('Could not write profile %s' % dump)
+      dump = None
+  entry = dict(
+      method=request.method,
+      path=request.path,
+      endpoint=request.endpoint,
+      time=time.time(),
+      seconds=seconds,
+      statements=statements,
+      profiler=profiler,
+      dump=dump)
+  evicted = None
+  with profiles_lock:
+    if len(profiles) == profiles.maxlen:
+      evicted = profiles[0]
+    profiles.append(entry)
+  if evicted != None:
+    remove_profile_dump(evicted)
+
+
+def profile_trace(entry):
+  stream = StringIO()
+  pstats.Stats(entry['profiler'], stream=stream).sort_stats(
+      'cumulative').print_stats(20)
+  return dict(
+      method=entry['method'],
+      path=entry['path'],
+      endpoint=entry['endpoint'],
+      time=entry['time'],
+      seconds=entry['seconds'],
+      sql=[dict(sql=redact_sql(s['sql']), seconds=s['seconds'])
+        for s in entry['statements']],
+      profile=stream.getvalue())
+
+
 @app.before_request
 def before_request():
-  g.db = connect_db()
+  g.profiler = None
+  if profile_request():
+    g.db = connect_db(profile=True)
+    g.profile_start = time.time()
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+  else:
+    g.db = connect_db()
 
 
 @app.teardown_request
 def teardown_request(exception):
-  g.db.close()
+  try:
+    if g.profiler != None:
+      g.profiler.disable()
+      record_profile(g.profiler, g.db.statements,
+          time.time() - g.profile_start)
+  finally:
+    g.db.close()
 
 
 @app.route('/')
@@ -123,6 +343,28 @@ def resource_not_found(error):
       {"Content-Type": "application/json"})
 
 
+@app.route('/profiles', methods=['GET'])
+def get_profiles():
+  if not profiling or not valid_profile_token():
+    abort(404)
+  with profiles_lock:
+    entries = list(profiles)
+  slowest = heapq.nlargest(app.config['PROFILE_KEEP'], entries,
+      key=lambda entry: entry['seconds'])
+  return jsonify(
+        { 'profiles': map(profile_trace, slowest) }
+      )
+
+
+@app.route('/profiles', methods=['DELETE'])
+def delete_profiles():
+  if not profiling or not valid_profile_token():
+    abort(404)
+  return jsonify(
+        { 'profiles deleted': clear_profiles() }
+      )
+
+
 @app.route('/users/<string:name>', methods=["GET"])
 def get_user_by_name(name):
   uid = get_uid_by_name(name, like=True)
@@ -277,6 +519,152 @@ def delete_user(uid):
     )
 
 
+def connect_maintenance_db():
+  """
+  Opens a connection for the maintenance commands. The connection is in
+  autocommit mode, so every statement releases its locks as soon as it is
+  done, and it waits for the request handlers instead of failing when the
+  database is busy. The database is switched to WAL mode (this is
+  persistent), so the maintenance readers never block writing requests.
+  """
+  db = sqlite3.connect(app.config['DATABASE'], timeout=30)
+  db.isolation_level = None
+  db.execute('PRAGMA journal_mode=WAL').fetchall()
+  return db
+
+
+def db_pragma(db, name):
+  return db.execute('PRAGMA %s' % name).fetchone()[0]
+
+
+def db_size(db):
+  return db_pragma(db, 'page_count') * db_pragma(db, 'page_size')
+
+
+def vacuum_db():
+  """
+  Returns free pages to the file system in steps of
+  MAINTENANCE_STEP_PAGES pages. Only works on databases created with
+  auto_vacuum=INCREMENTAL (see schema.sql), for other databases the
+  report says how to enable it.
+  """
+  start = time.time()
+  with closing(connect_maintenance_db()) as db:
+    if db_pragma(db, 'auto_vacuum') != 2:
+      return dict(
+          command='vacuum',
+          seconds=time.time() - start,
+          bytes=0,
+          result='auto_vacuum is disabled, run "PRAGMA '
+            'auto_vacuum=INCREMENTAL; VACUUM" once to enable it')
+    page_size = db_pragma(db, 'page_size')
+    free_before = free = db_pragma(db, 'freelist_count')
+    while free > 0:
+      db.execute('PRAGMA incremental_vacuum(%i)' %
+          app.config['MAINTENANCE_STEP_PAGES']).fetchall()
+      remaining = db_pragma(db, 'freelist_count')
+      if remaining >= free:
+        break
+      free = remaining
+      time.sleep(app.config['MAINTENANCE_STEP_PAUSE'])
+  return dict(
+      command='vacuum',
+      seconds=time.time() - start,
+      bytes=(free_before - free) * page_size)
+
+
+def analyze_db():
+  """
+  Refreshes the query planner statistics for name_index, reading at most
+  MAINTENANCE_ANALYSIS_LIMIT rows. Reports the size of name_index if
+  sqlite is compiled with the dbstat table.
+  """
+  start = time.time()
+  with closing(connect_maintenance_db()) as db:
+    db.execute('PRAGMA analysis_limit=%i' %
+        app.config['MAINTENANCE_ANALYSIS_LIMIT']).fetchall()
+    db.execute('ANALYZE name_index')
+    report = dict(command='analyze', seconds=time.time() - start)
+    try:
+      report['bytes'] = db.execute('SELECT sum(pgsize) FROM dbstat '
+          'WHERE name="name_index"').fetchone()[0]
+    except sqlite3.OperationalError, e:
+      pass
+  return report
+
+
+def check_db():
+  """Runs PRAGMA integrity_check, 'ok' is returned if all is well."""
+  start = time.time()
+  with closing(connect_maintenance_db()) as db:
+    result = '\n'.join(
+        row[0] for row in db.execute('PRAGMA integrity_check').fetchall())
+    size = db_size(db)
+  return dict(
+      command='check',
+      seconds=time.time() - start,
+      bytes=size,
+      result=result)
+
+
+def backup_db(target):
+  """
+  Writes a copy of the live database to target with VACUUM INTO, from a
+  single read transaction. The copy goes to a temporary file next to
+  target, which only replaces target once the copy is complete.
+  """
+  database = app.config['DATABASE']
+  if os.path.exists(target) and os.path.exists(database) and \
+      os.path.samefile(target, database):
+    raise ValueError('cannot back up %s onto itself' % database)
+  start = time.time()
+  fd, temp = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(target)))
+  os.close(fd)
+  try:
+    with closing(connect_maintenance_db()) as db:
+      db.execute('VACUUM INTO ?', (temp,))
+    os.rename(temp, target)
+  except:
+    os.unlink(temp)
+    raise
+  return dict(
+      command='backup',
+      seconds=time.time() - start,
+      bytes=os.path.getsize(target))
+
+
+MAINTENANCE_COMMANDS = {
+  'vacuum': (vacuum_db, 0),
+  'analyze': (analyze_db, 0),
+  'check': (check_db, 0),
+  'backup': (backup_db, 1)
+}
+
+
+def maintenance(command, *args):
+  report = MAINTENANCE_COMMANDS[command][0](*args)
+  line = '%(command)s: %(seconds).3fs' % report
+  if 'bytes' in report:
+    line += ', %(bytes)i bytes' % report
+  if 'result' in report:
+    line += ', ' + report['result']
+  return line
+
+
+configure_profiling()
+
+
 if __name__ == '__main__':
-  app.run()
+  if len(sys.argv) > 1:
+    if sys.argv[1] not in MAINTENANCE_COMMANDS or \
+        len(sys.argv) - 2 != MAINTENANCE_COMMANDS[sys.argv[1]][1]:
+      sys.exit('usage: %s [vacuum|analyze|check|backup <file>]' %
+          sys.argv[0])
+    try:
+      print(maintenance(*sys.argv[1:]))
+    except (ValueError, sqlite3.Error), e:
+      sys.exit('%s: %s' % (sys.argv[1], e))
+  else:
+    app.run()
   